@@ -1,11 +1,15 @@
-from typing import Any, Optional, Iterator
+from typing import Any, Literal, Optional, Iterator
 import os
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from functools import lru_cache
 import logging
 
 # Import dlt first
 import dlt
+from dlt.sources.helpers.requests import Client, Session
 from dlt.sources.rest_api import rest_api_source, RESTAPIConfig
+import orjson
+import requests
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -13,151 +17,210 @@ logger = logging.getLogger(__name__)
 # Get environment from dlt config, default to 'prod' for GitHub Actions
 ENVIRONMENT = dlt.config.get('runtime.environment') or 'prod'
 
+_BASE_URL = "https://api.evocon.com/api/reports/"
+
+# (name, absolute URL, primary key, resource hints) for each Evocon report endpoint;
+# absolute URLs let the REST client skip joining base_url onto every request
+_RESOURCE_TEMPLATES: tuple[tuple[str, str, list[str], dict[str, Any]], ...] = (
+    ("oee", f"{_BASE_URL}oee_json", ["shift_id"], {"columns": {"last_modified_time": {"dedup_sort": "desc"}}}),
+    ("losses", f"{_BASE_URL}losses_json", ["id"], {}),
+    ("scrap", f"{_BASE_URL}scrap_json", ["shift_id", "date", "station", "product_code", "scrap_reason_name"], {}),
+    ("downtime", f"{_BASE_URL}downtime_json", ["stop_instance_id"], {"columns": {"last_modified_time": {"dedup_sort": "desc"}}}),
+    ("checklists", f"{_BASE_URL}checklists_json", ["shift_id", "date", "station", "name", "itemname"], {}),
+    ("quantity", f"{_BASE_URL}quantity_json", ["id"], {}),
+    #NO DATA SEEN ON THIS ENDPOINT
+    # ("client_metrics", f"{_BASE_URL}clientmetrics_json", [], {}),
+)
+
 def date_range(start_date: str, end_date: str) -> Iterator[tuple[str, str]]:
     """Generate pairs of dates for each day in the range."""
-    current = datetime.strptime(start_date, "%Y-%m-%d")
-    end = datetime.strptime(end_date, "%Y-%m-%d")
+    start = date.fromisoformat(start_date).toordinal()
+    end = date.fromisoformat(end_date).toordinal()
     
-    while current <= end:
-        current_str = current.strftime("%Y-%m-%d")
+    # isoformat() skips strftime's format-string interpreter
+    for ordinal in range(start, end + 1):
+        current_str = date.fromordinal(ordinal).isoformat()
         yield current_str, current_str
-        current += timedelta(days=1)
+
+def _decode_with_orjson(send: Any) -> Any:
+    """Wrap Session.send so each response body is decoded once with orjson, straight from the raw bytes."""
+
+    def wrapped(request: requests.PreparedRequest, **kwargs: Any) -> requests.Response:
+        response = send(request, **kwargs)
+        parsed: list[Any] = []
+
+        def json(**_: Any) -> Any:
+            # dlt's paginator detection and data selection call .json() several times per page
+            if not parsed:
+                parsed.append(orjson.loads(response.content))
+            return parsed[0]
+
+        response.json = json  # type: ignore[method-assign]
+        return response
+
+    return wrapped
+
+@lru_cache(maxsize=1)
+def get_session() -> Session:
+    """
+    Shared keep-alive session for all Evocon endpoints, so the TCP+TLS
+    handshake is paid once per process instead of once per request.
+
+    dlt's REST client only accepts a requests session, so there is no HTTP/2
+    multiplexing. The pool holds 20 connections, or more if extract.workers is
+    raised above that, so urllib3 never has to discard a pooled connection.
+    """
+    workers = dlt.config.get('extract.workers', int) or 5
+    # dlt's retrying client, as rest_api would build by default: tenacity retries
+    # 429/5xx and connection errors with exponential backoff, honouring Retry-After.
+    # Every wait, Retry-After included, is capped at 30s, so a worker spends at most
+    # ~120s in backoff across the 5 attempts of one request. The final response is
+    # handed back to RESTClient instead of raising, so its error handling still applies.
+    client = Client(
+        request_timeout=dlt.config.get('runtime.request_timeout', float) or 60,
+        max_connections=max(20, workers),
+        raise_for_status=False,
+        request_max_attempts=5,
+        request_backoff_factor=0.5,
+        request_max_retry_delay=30,
+        respect_retry_after_header=True,
+    )
+    session = client.session
+    session.headers.update({"Connection": "keep-alive"})
+    # RESTClient replaces session-level response hooks with its own, so decode in send instead
+    session.send = _decode_with_orjson(session.send)  # type: ignore[method-assign]
+    return session
+
+@lru_cache(maxsize=None)
+def _get_creds(secrets_backend: Literal["dlt", "env"] = "dlt") -> tuple[str, str]:
+    """
+    Resolve the Evocon credentials once per process. 'dlt' goes through dlt.secrets,
+    which checks the SOURCES__EVOCON__* environment variables before secrets.toml;
+    'env' reads only those environment variables, with no secrets.toml fallback.
+    """
+    if secrets_backend == "env":
+        api_key = os.environ.get('SOURCES__EVOCON__API_KEY')
+        api_secret = os.environ.get('SOURCES__EVOCON__SECRET')
+    else:
+        api_key = dlt.secrets['sources.evocon.api_key']
+        api_secret = dlt.secrets['sources.evocon.secret']
+    
+    if not api_key or not api_secret:
+        source = (
+            "the SOURCES__EVOCON__* environment variables" if secrets_backend == "env"
+            else "dlt secrets (SOURCES__EVOCON__* environment variables or secrets.toml)"
+        )
+        logger.error(f"API key or secret is missing from {source}")
+        raise ValueError("API credentials are not set properly")
+    
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"API Key: {api_key[:5]}...{api_key[-5:]}")
+        logger.debug(f"API Secret: {api_secret[:5]}...{api_secret[-5:]}")
+    
+    return api_key, api_secret
 
 @dlt.source(name="evocon")
-def evocon_source(start_date: str, end_date: str, resources: Optional[list[str]] = None) -> Any:
+def evocon_source(
+    start_date: str,
+    end_date: str,
+    *,
+    resources: Optional[list[str]] = None,
+    secrets_backend: Literal["dlt", "env"] = "dlt",
+    api_key: Optional[str] = None,
+    api_secret: Optional[str] = None,
+) -> Any:
     """
     Evocon API source with date range parameters
     Args:
         start_date: Start date in YYYY-MM-DD format
         end_date: End date in YYYY-MM-DD format
         resources: Optional list of specific resources to load. If None, loads all resources.
+        secrets_backend: 'dlt' reads credentials through dlt.secrets (environment variables,
+            then secrets.toml); 'env' reads only the SOURCES__EVOCON__* environment
+            variables. Defaults to 'dlt'.
+        api_key: Optional pre-resolved API key. Looked up via secrets_backend if not given.
+        api_secret: Optional pre-resolved API secret. Looked up via secrets_backend if not given.
     """
-    # Get credentials directly from dlt.secrets
-    api_key = dlt.secrets['sources.evocon.api_key']
-    api_secret = dlt.secrets['sources.evocon.secret']
-    
     if not api_key or not api_secret:
-        logger.error("API key or secret is missing from secrets.toml")
-        raise ValueError("API credentials are not set properly")
+        api_key, api_secret = _get_creds(secrets_backend)
     
-    logger.info(f"API Key: {api_key[:5]}...{api_key[-5:]}")
-    logger.info(f"API Secret: {api_secret[:5]}...{api_secret[-5:]}")
+    # One page per day; every endpoint resolves its window from it so the
+    # per-day requests fan out over the extract thread pool
+    @dlt.resource(name="days", selected=False)
+    def days() -> Iterator[list[dict[str, str]]]:
+        for day_start, day_end in date_range(start_date, end_date):
+            yield [{"start": day_start, "end": day_end}]
+
+    # Shared by every endpoint; dlt clones it per resource
+    params = {
+        "startTime": "{resources.days.start}",
+        "endTime": "{resources.days.end}",
+    }
     
     # Create base configuration
     base_config: RESTAPIConfig = {
         "client": {
-            "base_url": "https://api.evocon.com/api/reports/",
+            "base_url": _BASE_URL,
+            "session": get_session(),
             "auth": {
                 "type": "http_basic",
                 "username": api_key,
                 "password": api_secret,
             },
         },
+        "resource_defaults": {
+            # Endpoints are I/O bound and independent, so let dlt extract them concurrently
+            "parallelized": True,
+            "write_disposition": "merge",
+            # Keep each endpoint a single root table: dlt then merges straight from the
+            # staging table instead of materializing temp tables for the child rows
+            "max_table_nesting": 0,
+        },
         "resources": [
-            {
-                "name": "oee",
-                "endpoint": {
-                    "path": "oee_json",
-                    "params": {
-                        "startTime": start_date,
-                        "endTime": end_date,
-                    }
-                },
-                "primary_key": ["shift_id"],
-                "columns":{"last_modified_time": {"dedup_sort": "desc"}}
-            },
-            {
-                "name": "losses",
-                "endpoint": {
-                    "path": "losses_json",
-                    "params": {
-                        "startTime": start_date,
-                        "endTime": end_date,
-                    }
-                },
-                "primary_key": ["id"]
-            },
-            {
-                "name": "scrap",
-                "endpoint": {
-                    "path": "scrap_json",
-                    "params": {
-                        "startTime": start_date,
-                        "endTime": end_date,
-                    }
-                },
-                "primary_key": ["shift_id", "date", "station", "product_code", "scrap_reason_name"]
-            },
-            {
-                "name": "downtime",
-                "endpoint": {
-                    "path": "downtime_json",
-                    "params": {
-                        "startTime": start_date,
-                        "endTime": end_date,
-                    }
-                },
-                "primary_key": ["stop_instance_id"],
-                "columns":{"last_modified_time": {"dedup_sort": "desc"}}
-            },
-            {
-                "name": "checklists",
-                "endpoint": {
-                    "path": "checklists_json",
-                    "params": {
-                        "startTime": start_date,
-                        "endTime": end_date,
-                    }
-                },
-                "primary_key": ["shift_id", "date", "station", "name", "itemname"]
-            },
-            {
-                "name": "quantity",
-                "endpoint": {
-                    "path": "quantity_json",
-                    "params": {
-                        "startTime": start_date,
-                        "endTime": end_date,
-                    }
-                },
-                "primary_key": ["id"]
-            },
-            #NO DATA SEEN ON THIS ENDPOINT
-            # {
-            #     "name": "client_metrics",
-            #     "endpoint": {
-            #         "path": "clientmetrics_json",
-            #         "params": {
-            #             "startTime": start_date,
-            #             "endTime": end_date,
-            #         }
-            #     },
-            # },
+            days,
+            *(
+                {"name": name, "endpoint": {"path": path, "params": params}, "primary_key": primary_key, **hints}
+                for name, path, primary_key, hints in _RESOURCE_TEMPLATES
+            ),
         ],
     }
     
-    # Create source once with the full date range
+    # Create source once for the full date range, partitioned by day
     source = rest_api_source(base_config)
     
     # Define available resources
-    available_resources = ["oee", "losses", "scrap", "downtime", "checklists", "quantity"]
+    available_resources = [name for name, *_ in _RESOURCE_TEMPLATES]
     
     # If specific resources are requested, validate and yield only those
     if resources:
         invalid_resources = [r for r in resources if r not in available_resources]
         if invalid_resources:
             raise ValueError(f"Invalid resources requested: {invalid_resources}. Available resources are: {available_resources}")
-        for resource in resources:
+        # Drop repeated names: dlt rejects a source that yields the same resource twice
+        for resource in dict.fromkeys(resources):
             yield source.resources[resource]
     else:
         # Yield all resources if none specified
         for resource in available_resources:
             yield source.resources[resource]
 
+@lru_cache(maxsize=1)
+def get_pipeline(pipeline_name: str, destination: str, dataset_name: str) -> dlt.Pipeline:
+    """
+    Reuse one pipeline handle per process, so repeated loads keep the
+    destination client state instead of re-initializing it on every call.
+    """
+    return dlt.pipeline(
+        pipeline_name=pipeline_name,
+        destination=destination,
+        dataset_name=dataset_name,
+        export_schema_path="schemas/export"
+    )
+
 def load_evocon_data(
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
-    write_disposition: str = "merge",
+    write_disposition: Optional[str] = None,
     environment: str = "dev",
     resources: Optional[list[str]] = None
 ) -> None:
@@ -166,7 +229,7 @@ def load_evocon_data(
     Args:
         start_date (str, optional): Start date in YYYY-MM-DD format. Defaults to 2 days ago.
         end_date (str, optional): End date in YYYY-MM-DD format. Defaults to today.
-        write_disposition (str): Write disposition for the pipeline. Defaults to "merge".
+        write_disposition (str, optional): Overrides the per-resource write dispositions. Defaults to None.
         environment (str): Environment to run the pipeline in ('dev' or 'prod'). Defaults to 'dev'.
         resources: Optional list of specific resources to load. If None, loads all resources.
     """
@@ -179,21 +242,20 @@ def load_evocon_data(
     dataset_name = f"evocon{'_staging' if ENVIRONMENT == 'dev' else ''}"
     logger.info(f"Running pipeline in {ENVIRONMENT} environment using dataset {dataset_name}")
     
-    pipeline = dlt.pipeline(
-        pipeline_name="evocon_pipeline",
-        destination='snowflake',
-        dataset_name=dataset_name,
-        export_schema_path="schemas/export"
-    )
+    pipeline = get_pipeline("evocon_pipeline", 'snowflake', dataset_name)
 
-    # Process data day by day
-    for day_start, day_end in date_range(start_date, end_date):
-        logger.info(f"Processing data for date: {day_start}")
-        load_info = pipeline.run(
-            evocon_source(day_start, day_end, resources),
-            write_disposition=write_disposition
-        )
-        print(f"Load info for {day_start}: {load_info}")
+    # Resolve credentials once per process and hand them to the source explicitly
+    api_key, api_secret = _get_creds()
+
+    # Days are fetched concurrently inside the source, so the whole range is one load
+    logger.info(f"Processing data from {start_date} to {end_date}")
+    load_info = pipeline.run(
+        evocon_source(start_date, end_date, resources=resources, api_key=api_key, api_secret=api_secret),
+        write_disposition=write_disposition,
+        # Columnar load files are PUT to the table stage and ingested with COPY INTO
+        loader_file_format="parquet"
+    )
+    print(f"Load info for {start_date} to {end_date}: {load_info}")
 
 if __name__ == "__main__":
     import argparse
@@ -208,7 +270,6 @@ if __name__ == "__main__":
     load_evocon_data(
         start_date=args.start_date,
         end_date=args.end_date,
-        write_disposition="merge",
         environment=args.environment,
         resources=args.resources
     )